@@ -1,26 +1,140 @@
 import streamlit as st
-from langchain.callbacks.base import BaseCallbackHandler
-from langchain.chat_models import ChatOpenAI
-from langchain.schema import ChatMessage
-from langchain.schema import FunctionMessage
+from openai import AsyncOpenAI, OpenAIError
 import os
+import re
+import time
 import requests
-import json
+from requests.adapters import HTTPAdapter
+import urllib3
+from urllib3.util import Retry
+from functools import lru_cache
+from operator import itemgetter
+import orjson
+import ijson
+import tiktoken
+import asyncio
+import aiohttp
+try:
+    import requests_cache
+except ImportError:
+    requests_cache = None
 
 openai_api_key = os.getenv("OPENAI_API_KEY")
 
-class StreamHandler(BaseCallbackHandler):
+# Sampling temperature and retry count of the chat model, the defaults LangChain's ChatOpenAI used
+CHAT_TEMPERATURE = 0.7
+OPENAI_MAX_RETRIES = 6
+
+# Conversation window: messages older than the last RECENT_MESSAGES_K are folded into a running summary
+RECENT_MESSAGES_K = 6
+SUMMARY_MODEL = "gpt-3.5-turbo-16k"
+SUMMARY_INPUT_TOKENS = 8000
+# Per-message cap on summarizer input, so one large function result cannot crowd out the messages after it
+SUMMARY_MESSAGE_TOKENS = 1000
+# Hard cap on prompt tokens per model, leaving room for the completion
+MAX_PROMPT_TOKENS = {
+    "gpt-3.5-turbo-16k": 12000,
+    "gpt-4": 6000,
+}
+
+# Connection limits for the clinicaltrials.gov HTTP clients
+HTTP_POOL_SIZE = 20
+HTTP_KEEPALIVE_TIMEOUT = 30
+
+@st.cache_resource
+def get_session():
+    """
+    Shared keep-alive session so repeat calls reuse the TCP/TLS connection, built once per process.
+    With requests_cache installed, responses are also persisted to sqlite across restarts.
+    """
+    if requests_cache is not None:
+        session = requests_cache.CachedSession("clinicaltrials_cache", backend="sqlite", expire_after=86400)
+    else:
+        session = requests.Session()
+    session.headers.update({"Accept-Encoding": "gzip"})
+    session.mount("https://", HTTPAdapter(
+        pool_connections=HTTP_POOL_SIZE,
+        pool_maxsize=HTTP_POOL_SIZE,
+        max_retries=Retry(total=3, backoff_factor=0.2, status_forcelist=[429, 500, 502, 503, 504], raise_on_status=False)
+    ))
+    return session
+
+# Strips all whitespace from the NCT_ID list passed to get_field_info
+_WS_TABLE = str.maketrans("", "", " \t\r\n")
+
+# Accessors for the identification module of a study in a search response
+_get_protocol = itemgetter("protocolSection")
+_get_id_module = itemgetter("identificationModule")
+
+# Path of the NCT_ID in a study's JSON, used to key batched responses
+NCT_ID_PATH = ("protocolSection", "identificationModule", "nctId")
+
+def _get_path(data, path: tuple):
+    """
+    Walk a tuple of keys into nested JSON with dict.get, returning None if any level is missing.
+    """
+    node = data
+    for key in path:
+        node = node.get(key) if isinstance(node, dict) else None
+    return node
+
+def _read_json(response):
+    """
+    Parse a streamed response's body with orjson, reading it straight off the gunzipped raw stream.
+    """
+    response.raw.decode_content = True
+    return orjson.loads(response.raw.read())
+
+def _fetch_studies_batch(nct_ids: tuple, api_path: str):
+    """
+    Get the JSON for several studies in a single request, keyed by NCT_ID.
+    """
+    url = "https://www.clinicaltrials.gov/api/v2/studies"
+    params = {
+        "format": "json",
+        "filter.ids": ",".join(nct_ids),
+        "fields": f"{'.'.join(NCT_ID_PATH)},{api_path}",
+        "pageSize": len(nct_ids)
+    }
+
+    studies = {}
+    with get_session().get(url, params=params, stream=True) as response:
+        response.raise_for_status()
+        # stream the studies out of the body one at a time instead of parsing the whole envelope
+        # use_float keeps numbers as floats, orjson cannot serialize ijson's default Decimals
+        response.raw.decode_content = True
+        for study in ijson.items(response.raw, "studies.item", use_float=True):
+            nct_id = _get_path(study, NCT_ID_PATH)
+            if nct_id is not None:
+                studies[nct_id] = study
+    return studies
+
+class StreamHandler():
     def __init__(self, container, initial_text=""):
         self.container = container
         self.text = initial_text
+        # tokens are buffered and rendered in chunks, re-rendering on every token is O(n^2) in the output length
+        self._buf = []
+        self._last_flush = time.monotonic()
+        self._flush_interval = 0.05
 
     def on_llm_new_token(self, token: str, **kwargs) -> None:
-        self.text += token
-        self.container.markdown(self.text)
-
-class ClinicalFunctions():
-    def __init__(self):
-        self.system_message = """
+        self._buf.append(token)
+        if time.monotonic() - self._last_flush > self._flush_interval or len(self._buf) > 16:
+            self._flush()
+
+    def on_llm_end(self, **kwargs) -> None:
+        self._flush()
+
+    def _flush(self):
+        if self._buf:
+            self.text += "".join(self._buf)
+            self._buf.clear()
+            self.container.markdown(self.text)
+        self._last_flush = time.monotonic()
+
+# The clinical trials system prompt is split into sections so each turn only sends the ones its query needs
+_OPS = """
         You are an AI operator of the clinicaltrials.gov API. You are an expert at complex searches. You may use full Essie expression syntax.
             Instructions:
             1. Boolean Operators: `OR`, `AND`, `NOT`
@@ -45,7 +159,9 @@ class ClinicalFunctions():
             The order in which search expressions are evaluated is as follows: Source expression > Operator expression > AND expression > OR expression. Use parentheses to increase the precedence of an expression.
 
             Escape operators to search for them as terms with a backslash (`\`).
+"""
 
+_AREAS = """
             Available areas to search with the AREA operator:
                 "NCTId",
                 "Acronym",
@@ -90,23 +206,34 @@ class ClinicalFunctions():
                 "OtherOutcomeDescription",
                 "OutcomeMeasureDescription",
                 "LocationContactName"
-            
+"""
+
+_EXAMPLES_HEADER = """
             Example Usage:
+"""
+
+_EXAMPLES_AREA = """
             Search for studies involving "heart attack" and aspirin, but not involving diabetes, while limiting search to trials in New York, United States.
             ` heart attack AND AREA[InterventionName]aspirin AND NOT diabetes AND AREA[LocationCity]New York AND AREA[LocationState]"New York AND AREA[LocationCountry]United States `
-            
-            Search for studies that include sleep deprivation or exhaustion, focus on adults (age 18-65), and are currently recruiting in Maryland.
-            ` EXPANSION[Concept](sleep deprivation OR exhaustion) AND AREA[EligibilityMinimumAge]RANGE[18,65] AND AREA[LocationStatus]Recruiting AND AREA[LocationState]Maryland `
-            
+
             Search for studies on asthma that involve the intervention named "inhaler" and are currently recruiting in the city of Chicago, Illinois, United States
             ` asthma AND AREA[InterventionName]inhaler AND AREA[LocationStatus]Recruiting AND AREA[LocationCity]Chicago AND AREA[LocationState]Illinois AND AREA[LocationCountry]United States `
-            
-            Search for studies on cancer, prioritizing the most recent ones, 
-            ` TILT[StudyFirstPostDate]cancer `
-            
+"""
+
+_EXAMPLES_ELIGIBILITY = """
+            Search for studies that include sleep deprivation or exhaustion, focus on adults (age 18-65), and are currently recruiting in Maryland.
+            ` EXPANSION[Concept](sleep deprivation OR exhaustion) AND AREA[EligibilityMinimumAge]RANGE[18,65] AND AREA[LocationStatus]Recruiting AND AREA[LocationState]Maryland `
+
             Search for studies on obesity that are conducted on patients aged between 30 and 50, and are based in the state of Texas, United States
             ` obesity AND AREA[EligibilityMinimumAge]RANGE[30,50] AND AREA[LocationState]Texas AND AREA[LocationCountry]United States `
+"""
+
+_EXAMPLES_TILT = """
+            Search for studies on cancer, prioritizing the most recent ones, 
+            ` TILT[StudyFirstPostDate]cancer `
+"""
 
+_IMPORTANT = """
             IMPORTANT:
             Ensure you are using proper AREA and TILT search operations -- these are your #1 tool. 
             ALWAYS think about how you can use search to fulfill the request. Resort to manually looking at the fields only if it is IMPOSSIBLE to get a good search query.
@@ -114,64 +241,278 @@ class ClinicalFunctions():
             Examples of AREA and TILT usage:
             'Rank order the top 10 studies on heart attack in the United States' -> use TILT instead of searching the studies.
             'Find studies on VEGF as an intervention' -> use AREA[InterventionName]VEGF instead of manually looking at the field studyArmsInterventions info.
-        """
-        self.functions = [
-            {
-                "name": "study_search",
-                "description": "Searches for studies on clinicaltrials.gov, and returns a list of study names and IDs.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "query_term": {
-                            "type": "string",
-                            "description": "The search query. See the system message for operator usage for complex queries."
-                        },          
-                        "pageSize": {
-                            "type": "integer",
-                            "description": "The number of results to return. Default 10, max 20."
-                        }
-                    }
+"""
+
+_SYSTEM_SECTIONS = {
+    "ops": _OPS,
+    "areas": _AREAS,
+    "examples_header": _EXAMPLES_HEADER,
+    "examples_area": _EXAMPLES_AREA,
+    "examples_eligibility": _EXAMPLES_ELIGIBILITY,
+    "examples_tilt": _EXAMPLES_TILT,
+    "important": _IMPORTANT,
+}
+
+# Query patterns that select each optional example section, matched on whole words
+_AREA_RE = re.compile(
+    r"(?i:\b(?:interventions?|drugs?|treatments?|therapy|therapies|sponsors?|sponsored|company|companies|investigators?"
+    r"|facility|facilities|hospitals?|locations?|located|city|cities|states?|country|countries|outcomes?|acronyms?|keywords?|mesh)\b)"
+    r"|\b(?:in|near|at) [A-Z]"
+)
+_ELIGIBILITY_RE = re.compile(
+    r"\b(?:ages?|aged|adults?|child|children|pediatric|elderly|older|years old|eligible|eligibility"
+    r"|recruiting|recruitment|enrolling|enrollment|women|men)\b",
+    re.I
+)
+_TILT_RE = re.compile(
+    r"\b(?:recent|most recently|latest|newest|ranks?|ranked|rank order|top \d+|prioritize|prioritizing|priority"
+    r"|(?:sorted|ordered) by|first posted)\b",
+    re.I
+)
+
+@lru_cache(maxsize=None)
+def assemble_system_message(section_names: tuple) -> str:
+    return "\n".join(_SYSTEM_SECTIONS[name] for name in section_names)
+
+def select_system_message(query: str) -> str:
+    """
+    Build the clinical trials system prompt with only the example sections the query looks like it needs.
+    """
+    examples = []
+    if _AREA_RE.search(query):
+        examples.append("examples_area")
+    if _ELIGIBILITY_RE.search(query):
+        examples.append("examples_eligibility")
+    if _TILT_RE.search(query):
+        examples.append("examples_tilt")
+
+    # the operator docs and closing guidance both point at the AREA list, so it is always sent
+    section_names = ["ops", "areas"]
+    if examples:
+        section_names += ["examples_header", *examples]
+    section_names.append("important")
+    return assemble_system_message(tuple(section_names))
+
+# Full system prompt, with every section
+SYSTEM_MESSAGE = assemble_system_message(tuple(_SYSTEM_SECTIONS))
+
+FUNCTIONS = [
+    {
+        "name": "study_search",
+        "description": "Searches for studies on clinicaltrials.gov, and returns a list of study names and IDs.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "query_term": {
+                    "type": "string",
+                    "description": "The search query. See the system message for operator usage for complex queries."
+                },          
+                "pageSize": {
+                    "type": "integer",
+                    "description": "The number of results to return. Default 10, max 20."
                 }
-            },
-            {
-                "name": "get_field_info",
-                "description": "Get a specific field's information for a study given its NCT_ID and field of interest. NCT_IDs are formatted like NCT00000000.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "nct_ids": {
-                            "type": "string",
-                            "description": """
-                            The NCT_IDs of the study to get information for, separated by commas: 'NCT00000000,NCT00000001,NCT00000002'
-                            """
-                        },
-                        "field": {
-                            "type": "string",
-                            "description": "The field to get information for. Available arguments: interventionAlone, studyArmsInterventions, patientConditions, studySummary, studyDesign, patientEligibility, organizations, primaryOutcomes, secondaryOutcomes, references, statusDates. Note, if InterventionAlone does not contain the intervention you are looking for, try studyArmsInterventions."
-                        # need to add: official title, detailed desc (manage tokens)
-                        }
-                    }
+            }
+        }
+    },
+    {
+        "name": "get_field_info",
+        "description": "Get a specific field's information for a study given its NCT_ID and field of interest. NCT_IDs are formatted like NCT00000000.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "nct_ids": {
+                    "type": "string",
+                    "description": """
+                    The NCT_IDs of the study to get information for, separated by commas: 'NCT00000000,NCT00000001,NCT00000002'
+                    """
+                },
+                "field": {
+                    "type": "string",
+                    "description": "The field to get information for. Available arguments: interventionAlone, studyArmsInterventions, patientConditions, studySummary, studyDesign, patientEligibility, organizations, primaryOutcomes, secondaryOutcomes, references, statusDates. Note, if InterventionAlone does not contain the intervention you are looking for, try studyArmsInterventions."
+                # need to add: official title, detailed desc (manage tokens)
                 }
-            },
-            {
-                "name": "save_csv",
-                "description": "Saves a string of comma separated values to a csv file.",
-                "parameters": {
-                    "type": "object",
-                    "properties": {
-                        "text": {
-                            "type": "string",
-                            "description": "The comma separated values to convert to a csv."
-                        },
-                        "title": {
-                            "type": "string",
-                            "description": "The title of the csv file, without the .csv extension."
-                        }
-                    }
+            }
+        }
+    },
+    {
+        "name": "save_csv",
+        "description": "Saves a string of comma separated values to a csv file.",
+        "parameters": {
+            "type": "object",
+            "properties": {
+                "text": {
+                    "type": "string",
+                    "description": "The comma separated values to convert to a csv."
+                },
+                "title": {
+                    "type": "string",
+                    "description": "The title of the csv file, without the .csv extension."
                 }
             }
-            # Add more functions here as dictionary elements in the list.
-        ]
+        }
+    }
+    # Add more functions here as dictionary elements in the list.
+]
+
+# clinicaltrials.gov v2 path of each get_field_info field in a study's JSON. Joined with dots,
+# it is also passed as the `fields` parameter so the API only returns the parts of the study we need.
+_FIELD_PATHS = {
+    "interventionAlone": ("derivedSection", "interventionBrowseModule", "browseLeaves"),
+    "studyArmsInterventions": ("protocolSection", "armsInterventionsModule", "armGroups"),
+    "patientConditions": ("protocolSection", "conditionsModule", "conditions"),
+    "studySummary": ("protocolSection", "descriptionModule", "briefSummary"),
+    "studyDesign": ("protocolSection", "designModule"),
+    "patientEligibility": ("protocolSection", "eligibilityModule"),
+    "organizations": ("protocolSection", "sponsorsCollaboratorsModule"),
+    "primaryOutcomes": ("protocolSection", "outcomesModule", "primaryOutcomes"),
+    "secondaryOutcomes": ("protocolSection", "outcomesModule", "secondaryOutcomes"),
+    "references": ("protocolSection", "referencesModule", "references"),
+    "statusDates": ("protocolSection", "statusModule"),
+}
+
+_FIELD_MISSING = {
+    "interventionAlone": "No interventions found",
+    "studyArmsInterventions": "No arms or interventions found",
+    "patientConditions": "No conditions found",
+    "studySummary": "No brief summary found",
+    "studyDesign": "No study design found",
+    "patientEligibility": "No eligibility criteria found",
+    "organizations": "No organizations found",
+    "primaryOutcomes": "No primary outcomes found",
+    "secondaryOutcomes": "No secondary outcomes found",
+    "references": "No references found",
+    "statusDates": "No status dates found",
+}
+
+def _study_search(query_term: str, pageSize: int):
+    """
+    Search clinicaltrials.gov for study names and IDs.
+    Returns the result and whether the request succeeded.
+    """
+    url = "https://www.clinicaltrials.gov/api/v2/studies"
+    params = {
+        "format": "json",
+        "query.parser": "advanced",
+        "query.term": query_term,
+        "pageSize": pageSize
+    }
+
+    with get_session().get(url, params=params, stream=True) as response:
+        data = _read_json(response) if response.status_code == 200 else None
+
+    if response.status_code == 200:
+        study_data = data['studies']
+
+        # Pull each study's identification module once, then read the names and NCT_IDs off it
+        id_modules = [_get_id_module(_get_protocol(study)) for study in study_data]
+        study_names = [module['briefTitle'] for module in id_modules]
+        nct_ids = [module['nctId'] for module in id_modules]
+
+        data_out = {
+            "Query Term": query_term,
+            "Page Size": pageSize,
+            "Number of Results": len(study_names),
+            "Study Name": study_names,
+            "NCT_ID": nct_ids
+        }
+
+        return data_out, True
+    else:
+        return f"Request failed with status code {response.status_code}", False
+
+def _get_field_info(nct_ids: list, field: str):
+    """
+    Get a field's information for each study.
+    Returns the result and whether every request succeeded.
+    """
+    # create a dictionary with each nct_id as keys to hold the data for each study
+    data_out = {
+        'nct_ids': nct_ids,  # Add nct_ids
+        'field': field,  # Add field
+    }
+    for nct_id in nct_ids:
+        data_out[nct_id] = None
+
+    path = _FIELD_PATHS.get(field)
+    if path is None:
+        for nct_id in nct_ids:
+            data_out[nct_id] = f"Field {field} is not a valid field. Valid fields are: {', '.join(_FIELD_PATHS)}."
+        return data_out, True
+    api_path = ".".join(path)
+
+    # one batched request for every study, keyed by NCT_ID
+    # sort and dedupe the ids so the request URL does not depend on the order they were asked for in
+    # the body is read off response.raw, so urllib3 and ijson errors are not wrapped by requests
+    try:
+        studies = _fetch_studies_batch(tuple(sorted(set(nct_ids))), api_path)
+    except (requests.RequestException, urllib3.exceptions.HTTPError, ijson.JSONError):
+        studies = {}
+
+    # fall back to concurrent per-study requests for anything the batch did not return
+    missing = [nct_id for nct_id in nct_ids if nct_id not in studies]
+    if missing:
+        params = {"fields": api_path, "format": "json"}
+        responses = asyncio.run(_fetch_studies_async(missing, params))
+        studies.update(zip(missing, responses))
+
+    failed = False
+    for nct_id in nct_ids:
+        response = studies[nct_id]
+        if isinstance(response, Exception):
+            temp_output = f"Request failed with error: {response}"
+            failed = True
+        elif isinstance(response, int):
+            temp_output = f"Request failed with status code {response}"
+            failed = True
+        else:
+            temp_output = _extract_field(response, field)
+
+        data_out[nct_id] = temp_output
+
+    return data_out, not failed
+
+async def _fetch_studies_async(nct_ids: list, params: dict):
+    """
+    Get the JSON for each study concurrently over one session.
+    Failed requests come back as their status code or exception, in the same order as nct_ids.
+    """
+    # the connector is bound to the event loop, so it is created per call
+    connector = aiohttp.TCPConnector(limit=HTTP_POOL_SIZE, keepalive_timeout=HTTP_KEEPALIVE_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        tasks = [_fetch_study_async(session, nct_id, params) for nct_id in nct_ids]
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+async def _fetch_study_async(session, nct_id: str, params: dict):
+    """
+    Get the JSON for a study given its NCT_ID, or the status code if the request failed.
+    """
+    url = f'https://www.clinicaltrials.gov/api/v2/studies/{nct_id}'
+    async with session.get(url, params=params) as response:
+        if response.status == 200:
+            return orjson.loads(await response.read())
+        return response.status
+
+def _extract_field(data: dict, field: str):
+    """
+    Pick the requested field out of a study's JSON.
+    """
+    node = _get_path(data, _FIELD_PATHS[field])
+    if node is None:
+        return _FIELD_MISSING[field]
+    return node
+
+@st.cache_data(ttl=1800, show_spinner=False)
+def _cached_study_search(query_term: str, pageSize: int):
+    return _study_search(query_term, pageSize)
+
+@st.cache_data(ttl=1800, show_spinner=False)
+def _cached_get_field_info(nct_ids: tuple, field: str):
+    return _get_field_info(list(nct_ids), field)
+
+class ClinicalFunctions():
+    def __init__(self):
+        self.system_message = SYSTEM_MESSAGE
+        self.functions = FUNCTIONS
         self.function_map = {
             "study_search": self.study_search,
             "get_field_info": self.get_field_info,
@@ -183,10 +524,13 @@ class ClinicalFunctions():
         """
         Saves a comma separated valued string directly to a csv file.
         """
+        if text is None or title is None:
+            return "Error saving file: both text and title are required"
+        path = os.path.join(os.getcwd(), f"{title}.csv")
         try:
-            with open(title + ".csv", 'w') as f:
-                f.write(text)
-            return "Saved to:" + os.getcwd() + "/" + title + ".csv"
+            with open(path, 'wb') as f:
+                f.write(text.encode('utf-8'))
+            return "Saved to:" + path
         except Exception as e:
             return "Error saving file: " + str(e)
         
@@ -195,130 +539,122 @@ class ClinicalFunctions():
         Searches for studies on clinicaltrials.gov, and returns a list of study names and IDs.
         This should be improved later -- not exactly the same as search on the site currently.
         """
-        url = "https://www.clinicaltrials.gov/api/v2/studies"
-        params = {
-            "format": "json",
-            "query.parser": "advanced",
-            "query.term": query_term,
-            "pageSize": pageSize
-        }
-
-        response = requests.get(url, params=params)
-
-        if response.status_code == 200:
-            data = response.json()
-            study_data = data['studies']
-
-            # Create a list to hold study names
-            study_names = []
-            nct_ids = []
-
-                        # Loop through the studies and add each name and NCT_ID to the respective list
-            for study in study_data:
-                study_names.append(study['protocolSection']['identificationModule']['briefTitle'])
-                nct_ids.append(study['protocolSection']['identificationModule']['nctId'])
-
-            data_out = {
-                "Query Term": query_term,
-                "Page Size": pageSize,
-                "Number of Results": len(study_names),
-                "Study Name": study_names,
-                "NCT_ID": nct_ids
-            }
-
-            return data_out
-        else:
-            return f"Request failed with status code {response.status_code}"
+        data_out, ok = _cached_study_search(query_term, pageSize)
+        if not ok:
+            # don't keep a failed request around for the cache ttl
+            _cached_study_search.clear(query_term, pageSize)
+        return data_out
 
     def get_field_info(self, nct_ids: str, field: str):
+        """
+        Get a specific field's information for each study given a comma separated string of NCT_IDs.
+        """
         # take the comma separated string of nct_ids and split it into a list
-        # get rid of any whitespace
-        nct_ids = nct_ids.replace(" ", "")
-        nct_ids = nct_ids.split(",")
-        # create a dictionary with each nct_id as keys to hold the data for each study
-        data_out = {
-            'nct_ids': nct_ids,  # Add nct_ids
-            'field': field,  # Add field
-        }
-        for nct_id in nct_ids:
-            data_out[nct_id] = None
-        # loop through the nct_ids and get the data for each study
-        for nct_id in nct_ids:
-            """Get the field information for a study given its NCT_ID."""
-            url = f'https://www.clinicaltrials.gov/api/v2/studies/{nct_id}'
-            response = requests.get(url)
-
-            if response.status_code == 200:
-                data = response.json()
-                
-                if field == "interventionAlone":
-                    try:
-                        temp_output = data['derivedSection']['interventionBrowseModule']['browseLeaves']
-                    except:
-                        temp_output = 'No interventions found'
-                elif field == "studyArmsInterventions":
-                    try: 
-                        temp_output = data['protocolSection']['armsInterventionsModule']['armGroups']
-                    except:
-                        temp_output = 'No arms or interventions found'
-                elif field == "patientConditions":
-                    try:
-                        temp_output = data['protocolSection']['conditionsModule']['conditions']
-                    except:
-                        temp_output = 'No conditions found'
-                elif field == "studySummary":
-                    try: 
-                        temp_output = data['protocolSection']['descriptionModule']['briefSummary']
-                    except:
-                        temp_output = 'No brief summary found'
-                elif field == "studyDesign":
-                    try:
-                        temp_output = data['protocolSection']['designModule']
-                    except:
-                        temp_output = 'No study design found'
-                elif field == "patientEligibility":
-                    try:
-                        temp_output = data['protocolSection']['eligibilityModule']
-                    except:
-                        temp_output = 'No eligibility criteria found'
-                elif field == "organizations":
-                    try:
-                        temp_output = data['protocolSection']['sponsorsCollaboratorsModule']
-                    except:
-                        temp_output = 'No organizations found'
-                elif field == "primaryOutcomes":
-                    try:
-                        temp_output = data['protocolSection']['outcomesModule']['primaryOutcomes']
-                    except:
-                        temp_output = 'No primary outcomes found'
-                elif field == "secondaryOutcomes":
-                    try:
-                        temp_output = data['protocolSection']['outcomesModule']['secondaryOutcomes']
-                    except:
-                        temp_output = 'No secondary outcomes found'
-                elif field == "references":
-                    try:
-                        temp_output = data['protocolSection']['referencesModule']['references']
-                    except:
-                        temp_output = 'No references found'
-                elif field == "statusDates":
-                    try:
-                        temp_output = data['protocolSection']['statusModule']
-                    except:
-                        temp_output = 'No status dates found'
-                else:
-                    temp_output = f"Field {field} is not a valid field. Valid fields are: studyArmsInterventions, patientConditions, studySummary, studyDesign, patientEligibility, organizations, primaryOutcomes, secondaryOutcomes, references, statusDates."
-            else:
-                temp_output = f"Request failed with status code {response.status_code}"
-
-            data_out[nct_id] = temp_output
-
+        # get rid of any whitespace in the same pass
+        nct_ids = tuple(nct_ids.translate(_WS_TABLE).split(","))
+        data_out, ok = _cached_get_field_info(nct_ids, field)
+        if not ok:
+            # don't keep failed requests around for the cache ttl
+            _cached_get_field_info.clear(nct_ids, field)
         return data_out
 
-        return self.system_message
+@st.cache_resource
+def get_clinical_functions():
+    return ClinicalFunctions()
+
+async def stream_completion(client: AsyncOpenAI, model: str, messages: list, functions: list, stream_handler: StreamHandler):
+    """
+    Stream a chat completion, sending content tokens to the stream handler.
+    Returns the content, and the function name and raw JSON arguments if the model asked for a function call.
+    """
+    kwargs = {"functions": functions} if functions else {}
+    stream = await client.chat.completions.create(
+        model=model, messages=messages, temperature=CHAT_TEMPERATURE, stream=True, **kwargs
+    )
+
+    content = []
+    function_name = None
+    function_args = []
+    async for chunk in stream:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            content.append(delta.content)
+            stream_handler.on_llm_new_token(delta.content)
+        if delta.function_call:
+            if delta.function_call.name:
+                function_name = delta.function_call.name
+            if delta.function_call.arguments:
+                function_args.append(delta.function_call.arguments)
+    stream_handler.on_llm_end()
+
+    return "".join(content), function_name, "".join(function_args)
+
+def message_text(msg) -> str:
+    """
+    Render a chat message as a single transcript line.
+    """
+    if msg["role"] == "function":
+        return f"function {msg['name']}: {msg['content']}"
+    return f"{msg['role']}: {msg['content']}"
+
+async def summarize_messages(client: AsyncOpenAI, summary: str, messages: list) -> str:
+    """
+    Fold messages into the running conversation summary with a cheap model call.
+    """
+    encoding = tiktoken.encoding_for_model(SUMMARY_MODEL)
+    lines = [encoding.decode(encoding.encode(message_text(msg))[:SUMMARY_MESSAGE_TOKENS]) for msg in messages]
+    # if many messages are folded at once, keep the newest ones
+    transcript = encoding.decode(encoding.encode("\n".join(lines))[-SUMMARY_INPUT_TOKENS:])
+
+    response = await client.chat.completions.create(model=SUMMARY_MODEL, temperature=0, messages=[
+        {"role": "system", "content": "Update the summary of the conversation with the new messages. Keep it brief, but keep any NCT_IDs, search queries and user preferences."},
+        {"role": "user", "content": f"Current summary:\n{summary}\n\nNew messages:\n{transcript}"}
+    ])
+    return response.choices[0].message.content
+
+async def summarize_history(client: AsyncOpenAI, turn_start: int):
+    """
+    Fold the messages that have fallen out of the window into the running summary. Called once at the start of a turn.
+    """
+    messages = st.session_state.messages
+    cutoff = max(min(len(messages) - RECENT_MESSAGES_K, turn_start), 0)
+    if cutoff > st.session_state["summarized_idx"]:
+        try:
+            summary = await summarize_messages(
+                client, st.session_state["summary"], messages[st.session_state["summarized_idx"]:cutoff]
+            )
+        except OpenAIError:
+            # keep the previous summary and window, the prompt token cap still bounds the request
+            return
+        st.session_state["summary"] = summary
+        st.session_state["summarized_idx"] = cutoff
+
+def build_prompt_messages(system_prompt: str, model: str, turn_start: int) -> list:
+    """
+    Build the messages sent to the model: the system prompt, the summary of older turns, the recent turns
+    and the current turn from the latest user message onward.
+    """
+    messages = st.session_state.messages
+    prefix = [{"role": "system", "content": system_prompt}]
+    if st.session_state["summary"]:
+        prefix.append({"role": "system", "content": f"Summary of the earlier conversation: {st.session_state['summary']}"})
+    recent = messages[st.session_state["summarized_idx"]:turn_start]
+    current = messages[turn_start:]
+
+    # enforce the hard token cap by dropping the oldest recent messages, the current turn is never dropped
+    encoding = tiktoken.encoding_for_model(model)
+    pinned_tokens = sum(len(encoding.encode(msg["content"])) for msg in prefix + current)
+    recent_tokens = [len(encoding.encode(msg["content"])) for msg in recent]
+    while recent and pinned_tokens + sum(recent_tokens) > MAX_PROMPT_TOKENS[model]:
+        recent = recent[1:]
+        recent_tokens = recent_tokens[1:]
+
+    return prefix + recent + current
 
 st.title('Chatbot')
-clinical_functions = ClinicalFunctions()
+clinical_functions = get_clinical_functions()
 
 model_choice = st.sidebar.radio("Choose Model", ("GPT-3.5-Turbo-16K", "GPT-4"))
 
@@ -326,10 +662,11 @@ st.sidebar.subheader("Plugins")
 choice = st.sidebar.radio("Choose Plugin", ("None", "Clinical Trials"))
 
 if choice == "Clinical Trials":
-    SYSTEM_PROMPT = (clinical_functions.system_message)
-    functions = clinical_functions.functions
+    SYSTEM_PROMPT = SYSTEM_MESSAGE
+    functions = FUNCTIONS
 else:
     SYSTEM_PROMPT = "You are a helpful assistant."
+    functions = None
 
 
 if model_choice == "GPT-3.5-Turbo-16K":
@@ -339,62 +676,76 @@ elif model_choice == "GPT-4":
 
 if "messages" not in st.session_state:
     st.session_state["messages"] = [
-        ChatMessage(role="assistant", content="How can I help you?"),
+        {"role": "assistant", "content": "How can I help you?"},
     ]
+    st.session_state["summary"] = ""
+    st.session_state["summarized_idx"] = 0
 
 for msg in st.session_state.messages:
-    if isinstance(msg, FunctionMessage):
-        st.chat_message('💻').write(f"Result: {msg.content}")
+    if msg["role"] == "function":
+        st.chat_message('💻').write(f"Result: {msg['content']}")
     else:
-        st.chat_message(msg.role).write(msg.content)
+        st.chat_message(msg["role"]).write(msg["content"])
 
 if prompt := st.chat_input():
-    st.session_state.messages.append(ChatMessage(role="user", content=prompt))
+    st.session_state.messages.append({"role": "user", "content": prompt})
+    # index of this turn's user message, everything from here on is sent in full
+    turn_start = len(st.session_state.messages) - 1
     st.chat_message("user").write(prompt)
 
     if not openai_api_key:
         st.info("Please add your OpenAI API key to continue.")
         st.stop()
 
+    if choice == "Clinical Trials":
+        SYSTEM_PROMPT = select_system_message(prompt)
+
     function_call_container = st.empty()
     function_response_container = st.empty()
 
 
     with st.chat_message("assistant"):
         stream_handler = StreamHandler(st.empty())
-        if choice != "None":
-            llm = ChatOpenAI(
-                openai_api_key=openai_api_key, streaming=True, callbacks=[stream_handler], model=model, functions = functions
-            )
-        else:
-            llm = ChatOpenAI(
-                openai_api_key=openai_api_key, streaming=True, callbacks=[stream_handler], model=model
+
+        async def run_turn():
+            # the client's connection pool is bound to the event loop asyncio.run creates, so it lives for one turn
+            async with AsyncOpenAI(api_key=openai_api_key, max_retries=OPENAI_MAX_RETRIES) as client:
+                return await run_turn_with(client)
+
+        async def run_turn_with(client):
+            await summarize_history(client, turn_start)
+            content, function_name, arguments = await stream_completion(
+                client, model, build_prompt_messages(SYSTEM_PROMPT, model, turn_start), functions, stream_handler
             )
-        response = llm(st.session_state.messages)
 
-        # Checking if GPT wanted to call a function
-        while response.additional_kwargs and "function_call" in response.additional_kwargs:
+            # Checking if GPT wanted to call a function
+            while function_name:
 
-            function_name = response.additional_kwargs['function_call']['name']
-            function_to_call = clinical_functions.function_map[function_name]
-            function_args = json.loads(response.additional_kwargs["function_call"]["arguments"])
+                function_to_call = clinical_functions.function_map[function_name]
+                function_args = orjson.loads(arguments)
 
-            # Call the function
-            with st.spinner("Calling function..."):
-                function_call_message = f"Calling function {function_name} with arguments: {function_args}"
-                function_call_container.chat_message("system").write(function_call_message)
-                st.session_state.messages.append(ChatMessage(role="system", content=function_call_message)) 
+                # Call the function
+                with st.spinner("Calling function..."):
+                    function_call_message = f"Calling function {function_name} with arguments: {function_args}"
+                    function_call_container.chat_message("system").write(function_call_message)
+                    st.session_state.messages.append({"role": "system", "content": function_call_message})
 
-                try:
-                    function_response = function_to_call(**function_args)
-                except Exception as e:
-                    function_response = f"Function call failed with error: {e}"
+                    # the functions are sync, run them off the event loop
+                    try:
+                        function_response = await asyncio.to_thread(function_to_call, **function_args)
+                    except Exception as e:
+                        function_response = f"Function call failed with error: {e}"
 
-            function_response_container.chat_message('💻').write(f"Function response: {function_response}")
+                function_response_container.chat_message('💻').write(f"Function response: {function_response}")
 
-            fx_message = FunctionMessage(name=function_name, content=json.dumps(function_response))
-            st.session_state.messages.append(fx_message)
+                fx_message = {"role": "function", "name": function_name, "content": orjson.dumps(function_response).decode()}
+                st.session_state.messages.append(fx_message)
 
-            response = llm(st.session_state.messages)
-        
-        st.session_state.messages.append(ChatMessage(role="assistant", content=response.content))
\ No newline at end of file
+                content, function_name, arguments = await stream_completion(
+                    client, model, build_prompt_messages(SYSTEM_PROMPT, model, turn_start), functions, stream_handler
+                )
+
+            return content
+
+        content = asyncio.run(run_turn())
+        st.session_state.messages.append({"role": "assistant", "content": content})